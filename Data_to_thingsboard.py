@@ -1,15 +1,18 @@
-import subprocess
+import signal
+import sys
+import asyncio
+import base64
 import time
-import json
-import csv
-import requests
+import orjson
+import aiohttp
 import logging
 import os
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from collections import defaultdict
+from Fetching_data import main as fetch_data
 
-# Setup logging
+# Setup logging (force replaces the console-only setup made by importing Fetching_data)
 logging.basicConfig(
+    force=True,
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
@@ -22,166 +25,265 @@ logging.basicConfig(
 THINGSBOARD_HOST = "http://localhost:8080"  # Replace with your ThingsBoard host
 DEVICE_TOKENS = {}  # Will store device tokens as {ip: access_token}
 TOKEN_FILE = "device_tokens.json"  # File to store tokens persistently
+TOKEN_FLUSH_INTERVAL = 1  # seconds between saves of newly created tokens
+TOKENS_DIRTY = False  # Set when DEVICE_TOKENS has changes not yet saved
 
-# File paths
-CSV_FILE = "modbus_data.csv"
-FETCHING_SCRIPT = "Fetching_data.py"
-LAST_PROCESSED_LINE = 0
+# ThingsBoard API credentials
+ADMIN_USERNAME = "tenant@thingsboard.org"  # Replace with your admin username
+ADMIN_PASSWORD = "tenant"  # Replace with your admin password
+JWT = {'token': None, 'exp': 0}  # Cached admin JWT and its expiry (epoch seconds)
+JWT_REFRESH_MARGIN = 30  # seconds before expiry to log in again
+
+# Request bodies are pre-encoded with orjson, so the content type is set explicitly
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# HTTP connection pool settings
+MAX_CONNECTIONS = 100
+KEEPALIVE_TIMEOUT = 60  # seconds
+
+# Telemetry keys forwarded from each row
+TELEMETRY_KEYS = ('current', 'voltage', 'temperature', 'power')
+
+# One lock per device IP so concurrent rows never create the same device twice
+DEVICE_LOCKS = defaultdict(asyncio.Lock)
+# Ensures only one task logs in when the cached JWT needs renewing; created in amain()
+# so it belongs to the running event loop (Python < 3.10 binds locks at creation)
+JWT_LOCK = None
 
 def load_device_tokens():
     """Load device tokens from file if it exists."""
     global DEVICE_TOKENS
     try:
         if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as f:
-                DEVICE_TOKENS = json.load(f)
+            with open(TOKEN_FILE, 'rb') as f:
+                DEVICE_TOKENS = orjson.loads(f.read())
                 logging.info(f"Loaded {len(DEVICE_TOKENS)} device tokens from file")
     except Exception as e:
         logging.error(f"Error loading device tokens: {str(e)}")
 
 def save_device_tokens():
-    """Save device tokens to file."""
+    """Save device tokens to file and return whether it succeeded."""
     try:
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump(DEVICE_TOKENS, f)
+        with open(TOKEN_FILE, 'wb') as f:
+            f.write(orjson.dumps(DEVICE_TOKENS))
             logging.info("Saved device tokens to file")
+        return True
     except Exception as e:
         logging.error(f"Error saving device tokens: {str(e)}")
+        return False
 
-class CSVHandler(FileSystemEventHandler):
-    def on_modified(self, event):
-        if event.src_path.endswith(CSV_FILE):
-            process_new_data()
+def jwt_expiry(token):
+    """Return the expiry (epoch seconds) from a JWT's payload, without verifying it."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return orjson.loads(base64.urlsafe_b64decode(payload)).get('exp', 0)
+    except Exception:
+        return 0
 
-def get_or_create_device(device_ip):
-    """Get or create a device in ThingsBoard and return its access token."""
-    if device_ip in DEVICE_TOKENS:
-        return DEVICE_TOKENS[device_ip]
+async def get_jwt(session, rejected=None):
+    """Return a cached admin JWT, logging in again only when it is about to expire.
 
-    # ThingsBoard API credentials
-    admin_username = "tenant@thingsboard.org"  # Replace with your admin username
-    admin_password = "tenant"  # Replace with your admin password
+    rejected is a token the server refused; it is only replaced if no other task
+    has renewed it in the meantime, so concurrent 401s cause a single login.
+    """
+    async with JWT_LOCK:
+        if (rejected is not None and JWT['token'] == rejected) or time.time() > JWT['exp'] - JWT_REFRESH_MARGIN:
+            auth_url = f"{THINGSBOARD_HOST}/api/auth/login"
+            auth_data = {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD}
+            async with session.post(auth_url, data=orjson.dumps(auth_data), headers=JSON_HEADERS) as auth_response:
+                JWT['token'] = orjson.loads(await auth_response.read())['token']
+            JWT['exp'] = jwt_expiry(JWT['token'])
+        return JWT['token']
 
-    # Get JWT token
-    auth_url = f"{THINGSBOARD_HOST}/api/auth/login"
-    auth_data = {"username": admin_username, "password": admin_password}
-    
-    try:
-        auth_response = requests.post(auth_url, json=auth_data)
-        jwt_token = auth_response.json()['token']
+async def admin_request(session, method, url, json=None):
+    """Make an authenticated ThingsBoard API call and return (status, json body).
 
-        # Create device if it doesn't exist
+    The request is retried once with a fresh JWT if the cached one was rejected.
+    """
+    data = orjson.dumps(json) if json is not None else None
+    rejected = None
+    for retry in (False, True):
+        token = await get_jwt(session, rejected)
         headers = {
             'Content-Type': 'application/json',
-            'X-Authorization': f'Bearer {jwt_token}'
+            'X-Authorization': f'Bearer {token}'
         }
+        async with session.request(method, url, headers=headers, data=data) as response:
+            if response.status == 401 and not retry:
+                rejected = token
+                continue
+            body = orjson.loads(await response.read()) if response.status == 200 else None
+            return response.status, body
 
-        # Check if device exists
-        device_name = f"modbus_device_{device_ip.replace('.', '_')}"
-        devices_url = f"{THINGSBOARD_HOST}/api/tenant/devices?deviceName={device_name}"
-        devices_response = requests.get(devices_url, headers=headers)
-
-        if devices_response.status_code == 200 and devices_response.json()['data']:
-            device_id = devices_response.json()['data'][0]['id']['id']
-        else:
-            # Create new device
-            device_data = {
-                "name": device_name,
-                "type": "modbus_device"
-            }
-            create_response = requests.post(
-                f"{THINGSBOARD_HOST}/api/device",
-                headers=headers,
-                json=device_data
-            )
-            device_id = create_response.json()['id']['id']
-
-        # Get device credentials
-        creds_url = f"{THINGSBOARD_HOST}/api/device/{device_id}/credentials"
-        creds_response = requests.get(creds_url, headers=headers)
-        access_token = creds_response.json()['credentialsId']
-
-        DEVICE_TOKENS[device_ip] = access_token
-        save_device_tokens()  # Save tokens whenever a new one is created
-        return access_token
+async def flush_device_tokens():
+    """Save device tokens at most once per TOKEN_FLUSH_INTERVAL while new ones arrive."""
+    global TOKENS_DIRTY
+    while True:
+        await asyncio.sleep(TOKEN_FLUSH_INTERVAL)
+        # Stay dirty if the save fails so the next tick retries it
+        if TOKENS_DIRTY and save_device_tokens():
+            TOKENS_DIRTY = False
 
-    except Exception as e:
-        logging.error(f"Error getting/creating device: {str(e)}")
-        return None
+async def get_or_create_device(session, device_ip):
+    """Get or create a device in ThingsBoard and return its access token."""
+    global TOKENS_DIRTY
+    if device_ip in DEVICE_TOKENS:
+        return DEVICE_TOKENS[device_ip]
 
-def process_new_data():
-    """Process new lines from the CSV file and send to ThingsBoard."""
-    global LAST_PROCESSED_LINE
-    
-    try:
-        with open(CSV_FILE, 'r') as f:
-            csv_reader = csv.DictReader(f)
-            rows = list(csv_reader)
-            
-            # Process only new rows
-            for row in rows[LAST_PROCESSED_LINE:]:
-                device_ip = row['device_ip']
-                access_token = get_or_create_device(device_ip)
-                
-                if not access_token:
-                    logging.error(f"Could not get access token for device {device_ip}")
-                    continue
+    async with DEVICE_LOCKS[device_ip]:
+        # Another task may have created the device while we were waiting
+        if device_ip in DEVICE_TOKENS:
+            return DEVICE_TOKENS[device_ip]
+
+        try:
+            # Check if device exists
+            device_name = f"modbus_device_{device_ip.replace('.', '_')}"
+            devices_url = f"{THINGSBOARD_HOST}/api/tenant/devices?deviceName={device_name}"
+            _, devices = await admin_request(session, 'GET', devices_url)
 
-                # Prepare telemetry data
-                telemetry = {
-                    'ts': int(time.time() * 1000),
-                    'values': {
-                        'current': float(row['current']),
-                        'voltage': float(row['voltage']),
-                        'temperature': float(row['temperature']),
-                        'power': float(row['power'])
-                    }
+            if devices and devices['data']:
+                device_id = devices['data'][0]['id']['id']
+            else:
+                # Create new device
+                device_data = {
+                    "name": device_name,
+                    "type": "modbus_device"
                 }
+                _, created = await admin_request(
+                    session, 'POST', f"{THINGSBOARD_HOST}/api/device", json=device_data
+                )
+                device_id = created['id']['id']
 
-                # Send data to ThingsBoard
-                tb_url = f"{THINGSBOARD_HOST}/api/v1/{access_token}/telemetry"
-                response = requests.post(tb_url, json=telemetry)
-                
-                if response.status_code == 200:
-                    logging.info(f"Successfully sent data to ThingsBoard for device {device_ip}")
-                else:
-                    logging.error(f"Failed to send data to ThingsBoard for device {device_ip}: {response.status_code}")
+            # Get device credentials
+            creds_url = f"{THINGSBOARD_HOST}/api/device/{device_id}/credentials"
+            _, creds = await admin_request(session, 'GET', creds_url)
+            access_token = creds['credentialsId']
 
-            LAST_PROCESSED_LINE = len(rows)
+            DEVICE_TOKENS[device_ip] = access_token
+            TOKENS_DIRTY = True  # Saved by flush_device_tokens
+            return access_token
 
-    except Exception as e:
-        logging.error(f"Error processing CSV data: {str(e)}")
+        except Exception as e:
+            logging.error(f"Error getting/creating device: {str(e)}")
+            return None
+
+async def send_telemetry(session, token, payload):
+    """Post a telemetry payload to ThingsBoard and return the HTTP status."""
+    tb_url = f"{THINGSBOARD_HOST}/api/v1/{token}/telemetry"
+    async with session.post(tb_url, data=orjson.dumps(payload), headers=JSON_HEADERS) as response:
+        return response.status
+
+async def forward_batch(session, device_ip, telemetry):
+    """Send all pending telemetry for one device to ThingsBoard in a single request."""
+    access_token = await get_or_create_device(session, device_ip)
+
+    if not access_token:
+        logging.error(f"Could not get access token for device {device_ip}")
+        return
+
+    # Send data to ThingsBoard
+    status = await send_telemetry(session, access_token, telemetry)
+
+    if status == 200:
+        logging.info(f"Successfully sent {len(telemetry)} data points to ThingsBoard for device {device_ip}")
+    else:
+        logging.error(f"Failed to send data to ThingsBoard for device {device_ip}: {status}")
+
+def queue_row(queue, row):
+    """Queue a row saved by Fetching_data for upload to ThingsBoard."""
+    queue.put_nowait((row['device_ip'], {
+        'ts': row['ts_ms'],
+        'values': {key: row[key] for key in TELEMETRY_KEYS if key in row}
+    }))
+
+async def process_new_data(session, queue):
+    """Send queued rows to ThingsBoard, batching whatever has arrived per device."""
+    while True:
+        device_ip, point = await queue.get()
+
+        # Group everything already queued by device so each device gets one POST
+        batches = defaultdict(list)
+        batches[device_ip].append(point)
+        while not queue.empty():
+            device_ip, point = queue.get_nowait()
+            batches[device_ip].append(point)
+
+        # Upload the batches concurrently
+        tasks = [forward_batch(session, device_ip, telemetry)
+                 for device_ip, telemetry in batches.items()]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Error sending data to ThingsBoard: {str(result)}")
+
+async def amain():
+    """Run data fetching and ThingsBoard upload; return False if they stopped on an error."""
+    global JWT_LOCK
+    JWT_LOCK = asyncio.Lock()
 
-def main():
     # Load existing device tokens
     load_device_tokens()
 
-    # Start the Fetching_data.py script as a subprocess
     try:
-        fetching_process = subprocess.Popen(['python', FETCHING_SCRIPT])
-        logging.info("Started Fetching_data.py successfully")
+        queue = asyncio.Queue()
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Run data fetching in this process, handing each row straight to the uploader
+            fetching_task = asyncio.create_task(fetch_data(on_row=lambda row: queue_row(queue, row)))
+            upload_task = asyncio.create_task(process_new_data(session, queue))
+            flush_task = asyncio.create_task(flush_device_tokens())
+            logging.info("Started data fetching successfully")
 
-        # Set up file monitoring
-        event_handler = CSVHandler()
-        observer = Observer()
-        observer.schedule(event_handler, path='.', recursive=False)
-        observer.start()
-        logging.info("Started CSV file monitoring")
+            # Stop on Ctrl-C or SIGTERM by cancelling the main loop right away
+            loop = asyncio.get_running_loop()
+            main_task = asyncio.current_task()
+            try:
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(sig, main_task.cancel)
+            except NotImplementedError:
+                # Not available on Windows event loops; Ctrl-C then raises
+                # KeyboardInterrupt from asyncio.run, which still cancels this task
+                pass
 
-        # Main loop
-        try:
-            while True:
-                time.sleep(5)
-        except KeyboardInterrupt:
-            observer.stop()
-            fetching_process.terminate()
-            logging.info("Stopping the application...")
+            # Main loop, which only ends early if data fetching gives up
+            stopped = False
+            try:
+                await asyncio.wait({fetching_task, upload_task}, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                stopped = True
+            finally:
+                logging.info("Stopping the application...")
+                fetching_task.cancel()
+                upload_task.cancel()
+                flush_task.cancel()
+                await asyncio.gather(fetching_task, upload_task, flush_task, return_exceptions=True)
 
-        observer.join()
-        fetching_process.wait()
+                # Don't lose tokens created since the last periodic save
+                if TOKENS_DIRTY:
+                    save_device_tokens()
+
+            # A task that finished on its own (rather than being cancelled above) failed
+            for name, task in (("Data fetching", fetching_task), ("ThingsBoard upload", upload_task)):
+                if task.cancelled():
+                    continue
+                if task.exception():
+                    logging.error(f"{name} failed: {str(task.exception())}", exc_info=task.exception())
+                elif not stopped:
+                    logging.error(f"{name} stopped unexpectedly")
+            return stopped
 
     except Exception as e:
         logging.error(f"Error in main process: {str(e)}")
+        return False
+
+def main():
+    try:
+        if not asyncio.run(amain()):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,12 +1,10 @@
-import json
-import subprocess
-import os
-from pymodbus.client import ModbusTcpClient
+import asyncio
 import struct
 import logging
 import time
 import csv
-from datetime import datetime
+import os
+from modbus_network_scan_script import scan, load_config
 
 # Setup logging
 logging.basicConfig(
@@ -18,8 +16,6 @@ logging.basicConfig(
 )
 
 # Constants from original script
-SCAN_SCRIPT = "modbus_network_scan_script.py"
-CONNECTED_DEVICES_FILE = "connected_devices.json"
 CSV_FILE = "modbus_data.csv"
 START_ADDRESS = 0
 TOTAL_REGISTERS = 56
@@ -27,6 +23,8 @@ ADDRESS_OFFSET = 30001
 POLLING_INTERVAL = 5  # seconds
 MAX_RECONNECTION_ATTEMPTS = 3
 RECONNECTION_DELAY = 5  # seconds
+DEFAULT_UNIT_ID = 0  # Modbus unit (slave) id, unless modbus_settings sets unit_id
+READ_TIMEOUT = 3  # seconds to wait for a raw Modbus connect or response
 
 # Parameter mapping
 PARAMETERS = {
@@ -36,39 +34,108 @@ PARAMETERS = {
     "power": [30033, 30034]
 }
 
+# CSV column order, fixed once so rows can be written as plain lists
+CSV_FIELDNAMES = ['ts_ms', 'device_ip', *PARAMETERS]
+
+# Pre-compiled struct formats for register decoding
+_FLOAT = struct.Struct('!f')
+_UINT32 = struct.Struct('!I')
+_REGISTER = struct.Struct('!H')
+_REGISTERS = struct.Struct(f'!{TOTAL_REGISTERS}H')
+_REGISTER_FLOATS = struct.Struct(f'!{TOTAL_REGISTERS // 2}f')
+
+# Modbus/TCP framing: MBAP header (transaction, protocol, length, unit) + PDU
+_READ_INPUT_REGISTERS = 0x04
+_MBAP_REQUEST = struct.Struct('!HHHBBHH')  # ... function, start address, count
+_MBAP_RESPONSE_HEADER = struct.Struct('!HHHBBB')  # ... function, byte count or exception code
+
+def parameter_indexes():
+    """Map PARAMETERS to (key, index1, index2, float_index) within one register read.
+
+    float_index is the position in registers_to_floats() output for pairs that are
+    adjacent and aligned, or None if the pair has to be decoded on its own.
+    """
+    indexes = []
+    for key, (reg1, reg2) in PARAMETERS.items():
+        index1 = reg1 - ADDRESS_OFFSET
+        index2 = reg2 - ADDRESS_OFFSET
+
+        if index1 < 0 or index2 < 0 or index1 >= TOTAL_REGISTERS or index2 >= TOTAL_REGISTERS:
+            logging.warning(f"Registers {reg1} and {reg2} are out of range.")
+            continue
+
+        float_index = index1 // 2 if index1 % 2 == 0 and index2 == index1 + 1 else None
+        indexes.append((key, index1, index2, float_index))
+    return tuple(indexes)
+
+# Parameter register positions, validated once at import
+PARAMETER_INDEXES = parameter_indexes()
+
 class ModbusDevice:
-    def __init__(self, ip, port=502):
+    """Modbus/TCP device read over a persistent asyncio stream."""
+
+    def __init__(self, ip, port=502, unit_id=DEFAULT_UNIT_ID):
         self.ip = ip
         self.port = port
-        self.client = None
+        self.unit_id = unit_id
+        self.reader = None
+        self.writer = None
+        self.transaction_id = 0
         self.connected = False
         self.reconnection_attempts = 0
         self.last_reconnection_time = 0
 
-    def connect(self):
-        """Attempt to connect to the Modbus device."""
+    async def connect(self):
+        """Attempt to open a TCP connection to the Modbus device."""
         try:
-            if self.client:
-                self.client.close()
-            
-            self.client = ModbusTcpClient(self.ip, port=self.port)
-            self.connected = self.client.connect()
-            
-            if self.connected:
-                self.reconnection_attempts = 0
-                logging.info(f"Successfully connected to {self.ip}")
-            return self.connected
+            self.disconnect()
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port), READ_TIMEOUT
+            )
+            self.connected = True
+            self.reconnection_attempts = 0
+            logging.info(f"Successfully connected to {self.ip}")
+            return True
         except Exception as e:
             logging.error(f"Error connecting to {self.ip}: {str(e)}")
             return False
 
     def disconnect(self):
         """Safely disconnect from the device."""
-        if self.client:
-            self.client.close()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
         self.connected = False
 
-    def attempt_reconnection(self):
+    async def read_input_registers(self, address, count):
+        """Read input registers as raw big-endian bytes, or None on a Modbus error response.
+
+        Any malformed or unexpected response raises ConnectionError, since the stream
+        can no longer be trusted to be aligned on a frame boundary.
+        """
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        self.writer.write(_MBAP_REQUEST.pack(
+            self.transaction_id, 0, 6, self.unit_id, _READ_INPUT_REGISTERS, address, count
+        ))
+        await asyncio.wait_for(self.writer.drain(), READ_TIMEOUT)
+
+        header = await asyncio.wait_for(self.reader.readexactly(_MBAP_RESPONSE_HEADER.size), READ_TIMEOUT)
+        transaction_id, protocol, length, unit, function, byte_count = _MBAP_RESPONSE_HEADER.unpack(header)
+        if transaction_id != self.transaction_id or protocol != 0 or unit != self.unit_id:
+            raise ConnectionError(
+                f"Unexpected Modbus response header (transaction {transaction_id}, protocol {protocol}, unit {unit})"
+            )
+        if function == _READ_INPUT_REGISTERS | 0x80:
+            logging.error(f"Modbus exception {byte_count} from {self.ip}")
+            return None
+        if function != _READ_INPUT_REGISTERS:
+            raise ConnectionError(f"Unexpected Modbus function code {function}")
+        if byte_count != 2 * count or length != byte_count + 3:
+            raise ConnectionError(f"Unexpected Modbus response size (length {length}, byte count {byte_count})")
+
+        return await asyncio.wait_for(self.reader.readexactly(byte_count), READ_TIMEOUT)
+
+    async def attempt_reconnection(self):
         """Attempt to reconnect to the device with backoff."""
         current_time = time.time()
         
@@ -81,109 +148,94 @@ class ModbusDevice:
         
         if self.reconnection_attempts <= MAX_RECONNECTION_ATTEMPTS:
             logging.info(f"Attempting reconnection to {self.ip} (Attempt {self.reconnection_attempts})")
-            return self.connect()
+            return await self.connect()
         else:
             logging.error(f"Max reconnection attempts reached for {self.ip}")
             return False
 
-def run_network_scan():
-    """Run the network scan script as a subprocess and wait for completion."""
+async def run_network_scan(config):
+    """Scan the network in-process and return the connected devices, or None on failure."""
     try:
         logging.info("Starting network scan...")
-        result = subprocess.run(['python', SCAN_SCRIPT], 
-                              check=True, 
-                              capture_output=True, 
-                              text=True)
-        
-        if result.returncode == 0:
-            logging.info("Network scan completed successfully")
-            return True
-        else:
-            logging.error(f"Network scan failed with error: {result.stderr}")
-            return False
+        devices = await scan(config)
+        logging.info("Network scan completed successfully")
+        return devices
     except Exception as e:
         logging.error(f"Error running network scan: {str(e)}")
-        return False
+        return None
 
 def registers_to_float(register1, register2):
     """Convert two registers to a float value."""
     combined_registers = (register1 << 16) | register2
-    return struct.unpack('!f', struct.pack('!I', combined_registers))[0]
+    return _FLOAT.unpack(_UINT32.pack(combined_registers))[0]
 
-def load_connected_devices():
-    """Load the list of connected devices from the JSON file."""
-    if not os.path.exists(CONNECTED_DEVICES_FILE):
-        logging.error(f"Connected devices file {CONNECTED_DEVICES_FILE} not found.")
-        return []
-
-    with open(CONNECTED_DEVICES_FILE, "r") as f:
-        return json.load(f)
+def registers_to_floats(payload):
+    """Convert the raw bytes of a full TOTAL_REGISTERS block to floats, one per register pair."""
+    return _REGISTER_FLOATS.unpack(payload)
 
 def initialize_csv(devices):
-    """Initialize CSV file with headers."""
-    fieldnames = ['timestamp', 'device_ip']
-    fieldnames.extend(PARAMETERS.keys())
-    
-    if not os.path.exists(CSV_FILE):
-        with open(CSV_FILE, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-    
-    return fieldnames
-
-def save_to_csv(data, ip, fieldnames):
-    """Save the data to CSV file."""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    """Open the CSV file for appending, writing headers if it is new, and return (writer, csvfile)."""
+    # Move aside a file written with a different header (e.g. the old string timestamps)
+    if os.path.exists(CSV_FILE) and os.path.getsize(CSV_FILE) > 0:
+        with open(CSV_FILE, 'r', newline='') as f:
+            header = next(csv.reader(f), [])
+        if header != CSV_FIELDNAMES:
+            archived = f"{os.path.splitext(CSV_FILE)[0]}_{int(time.time())}.csv"
+            os.replace(CSV_FILE, archived)
+            logging.warning(f"CSV header changed, moved old data to {archived}")
+
+    # Kept open for the whole run; line buffering flushes each row as it is written
+    csvfile = open(CSV_FILE, 'a', newline='', buffering=1)
+    writer = csv.writer(csvfile)
+    if csvfile.tell() == 0:
+        writer.writerow(CSV_FIELDNAMES)
+
+    return writer, csvfile
+
+def save_to_csv(writer, data, ip):
+    """Save the data to CSV file and return the written row."""
     row_data = {
-        'timestamp': timestamp,
+        'ts_ms': time.time_ns() // 1_000_000,  # Epoch milliseconds, as ThingsBoard expects
         'device_ip': ip
     }
     row_data.update(data['interpreted_values'])
-    
-    with open(CSV_FILE, 'a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writerow(row_data)
 
-def fetch_modbus_registers(device):
+    # Write by column position rather than through DictWriter's per-row key checks
+    writer.writerow([row_data.get(name, '') for name in CSV_FIELDNAMES])
+
+    return row_data
+
+async def fetch_modbus_registers(device):
     """Fetch data from Modbus input registers of a device."""
     if not device.connected:
-        if not device.attempt_reconnection():
+        if not await device.attempt_reconnection():
             return None
 
     try:
         logging.info(f"Reading registers {ADDRESS_OFFSET} to {ADDRESS_OFFSET + TOTAL_REGISTERS - 1} from {device.ip}...")
         
-        response = device.client.read_input_registers(
-            address=START_ADDRESS,
-            count=TOTAL_REGISTERS
-        )
+        payload = await device.read_input_registers(START_ADDRESS, TOTAL_REGISTERS)
 
-        if response is None or response.isError():
+        if payload is None:
             logging.error(f"Error reading registers from {device.ip}")
             device.connected = False
             return None
 
-        all_registers = response.registers
-        
-        data = {
-            "raw_registers": {},
-            "interpreted_values": {}
-        }
-
-        for i, value in enumerate(all_registers):
-            register_number = ADDRESS_OFFSET + i
-            data["raw_registers"][register_number] = value
-
-        for key, (reg1, reg2) in PARAMETERS.items():
-            index1 = reg1 - ADDRESS_OFFSET
-            index2 = reg2 - ADDRESS_OFFSET
+        if len(payload) != _REGISTERS.size:
+            logging.error(f"Expected {TOTAL_REGISTERS} registers from {device.ip}, got {len(payload) // 2}")
+            return None
 
-            if index1 < 0 or index2 < 0 or index1 >= len(all_registers) or index2 >= len(all_registers):
-                logging.warning(f"Registers {reg1} and {reg2} are out of range.")
-                continue
+        # Decode every aligned register pair straight from the response bytes in a single call
+        floats = registers_to_floats(payload)
 
-            value = registers_to_float(all_registers[index1], all_registers[index2])
-            data["interpreted_values"][key] = value
+        data = {
+            "interpreted_values": {
+                key: floats[float_index] if float_index is not None
+                else registers_to_float(_REGISTER.unpack_from(payload, 2 * index1)[0],
+                                        _REGISTER.unpack_from(payload, 2 * index2)[0])
+                for key, index1, index2, float_index in PARAMETER_INDEXES
+            }
+        }
 
         return data
     except Exception as e:
@@ -191,50 +243,68 @@ def fetch_modbus_registers(device):
         device.connected = False
         return None
 
-def main():
-    if not run_network_scan():
+async def main(on_row=None):
+    """Poll all connected Modbus devices forever, calling on_row with each saved row."""
+    try:
+        config = load_config()
+    except Exception as e:
+        logging.error(f"Error loading config: {str(e)}")
+        return
+    modbus_settings = config.get("modbus_settings", {})
+
+    devices = await run_network_scan(config)
+    if devices is None:
         logging.error("Network scan failed. Exiting...")
         return
 
-    logging.info("Loading connected devices...")
-    devices = load_connected_devices()
     if not devices:
         logging.error("No connected devices found.")
         return
 
-    fieldnames = initialize_csv(devices)
-
-    # Create ModbusDevice instances for each device
-    modbus_devices = {}
-    for device in devices:
-        if device.get("protocol") == "modbus":
-            ip = device.get("ip")
-            modbus_device = ModbusDevice(ip)
-            if modbus_device.connect():
-                modbus_devices[ip] = modbus_device
+    # Create ModbusDevice instances for each device and connect them concurrently
+    candidates = [ModbusDevice(device.get("ip"), port=modbus_settings.get("port", 502),
+                               unit_id=modbus_settings.get("unit_id", DEFAULT_UNIT_ID))
+                  for device in devices if device.get("protocol") == "modbus"]
+    connected = await asyncio.gather(*(device.connect() for device in candidates))
+    modbus_devices = {device.ip: device for device, ok in zip(candidates, connected) if ok}
 
     if not modbus_devices:
         logging.error("No Modbus devices connected.")
         return
 
+    writer, csvfile = initialize_csv(devices)
+
     try:
+        next_tick = time.monotonic()
         while True:
-            for ip, device in modbus_devices.items():
-                register_data = fetch_modbus_registers(device)
-                
+            # Poll every device concurrently so a cycle takes as long as the slowest one
+            results = await asyncio.gather(*(fetch_modbus_registers(device)
+                                             for device in modbus_devices.values()))
+
+            for ip, register_data in zip(modbus_devices, results):
                 if register_data:
-                    save_to_csv(register_data, ip, fieldnames)
+                    row_data = save_to_csv(writer, register_data, ip)
+                    if on_row:
+                        on_row(row_data)
                     logging.info(f"\nData from {ip}:")
                     for key, value in register_data["interpreted_values"].items():
                         logging.info(f"{key}: {value}")
-            
-            time.sleep(POLLING_INTERVAL)
 
-    except KeyboardInterrupt:
-        logging.info("\nStopping data collection...")
+            # Sleep until the next scheduled poll so the period doesn't drift with poll time;
+            # if a poll overran a whole interval, start again from now instead of bursting
+            next_tick += POLLING_INTERVAL
+            now = time.monotonic()
+            if next_tick < now:
+                next_tick = now
+            await asyncio.sleep(next_tick - now)
+
     finally:
         for device in modbus_devices.values():
             device.disconnect()
+        csvfile.close()
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("\nStopping data collection...")
@@ -1,13 +1,16 @@
 import json
-import time
 import ipaddress
+import asyncio
+import errno
+import selectors
 import socket
-import threading
-import os
+import time
 
 # Load the configuration from the file
-with open('config.json', 'r') as f:
-    config = json.load(f)
+def load_config(path='config.json'):
+    """Load the scan configuration from a JSON file."""
+    with open(path, 'r') as f:
+        return json.load(f)
 
 # Dynamically import functions from the protocol_functions.py file
 def import_protocol_function(protocol_name):
@@ -21,69 +24,129 @@ def import_protocol_function(protocol_name):
         print(f"Error importing function for protocol {protocol_name}: {e}")
         return None
 
-# Scan a single IP address
-def scan_ip(ip, port, timeout, result_list):
-    """Scan a single IP for open Modbus port and add to results if reachable."""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(timeout)
-            if s.connect_ex((str(ip), port)) == 0:
-                print(f"Device found at {ip}")
-                result_list.append(str(ip))
-    except Exception as e:
-        print(f"Error scanning {ip}: {e}")
-
-# Scan the network for devices using threading
-def scan_network(subnet, port, timeout):
-    """Scan the network using threading for faster execution."""
-    network = ipaddress.IPv4Network(subnet)
-    threads = []
+# Maximum number of connection probes (open sockets) in flight at once
+MAX_CONCURRENT_SCANS = 512
+
+# Probe every host with non-blocking connects multiplexed on one selector
+def probe_hosts(hosts, port, timeout):
+    """Probe hosts for an open port and return (ip, error) pairs; error is None if reachable."""
     results = []
+    pending = iter(hosts)
+    sel = selectors.DefaultSelector()
 
-    for ip in network.hosts():
-        thread = threading.Thread(target=scan_ip, args=(ip, port, timeout, results))
-        threads.append(thread)
-        thread.start()
-        if len(threads) >= 50:  # Limit the number of concurrent threads
-            for t in threads:
-                t.join()
-            threads = []
+    try:
+        while True:
+            # Keep up to MAX_CONCURRENT_SCANS connects in flight
+            while len(sel.get_map()) < MAX_CONCURRENT_SCANS:
+                ip = next(pending, None)
+                if ip is None:
+                    break
+                s = None
+                try:
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    s.setblocking(False)
+                    err = s.connect_ex((str(ip), port))
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        s.close()
+                        continue
+                    sel.register(s, selectors.EVENT_WRITE, (str(ip), time.monotonic() + timeout))
+                except Exception as e:
+                    # Don't leak the descriptor if setup failed after the socket was created
+                    if s is not None:
+                        s.close()
+                    results.append((str(ip), e))
 
-    # Ensure all remaining threads complete
-    for t in threads:
-        t.join()
+            if not sel.get_map():
+                break
 
-    return results
+            # Wait for connects to complete, but no longer than the earliest deadline
+            earliest = min(key.data[1] for key in sel.get_map().values())
+            for key, _ in sel.select(max(0, earliest - time.monotonic())):
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    results.append((key.data[0], None))
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
 
-# Modbus protocol: Only Modbus will be used here
-selected_protocol = "modbus"
+            # Give up on hosts that haven't answered in time
+            now = time.monotonic()
+            for key in [key for key in sel.get_map().values() if key.data[1] <= now]:
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
 
-# Import the Modbus protocol function
-protocol_function = import_protocol_function(selected_protocol)
+    return results
 
 # Scan the network for devices
-devices = scan_network(config["network_scan"]["subnet"], config["modbus_settings"]["port"], config["network_scan"]["scan_timeout"])
+async def scan_network(subnet, port, timeout):
+    """Scan the network, probing all hosts from a single selector loop in a worker thread."""
+    network = ipaddress.IPv4Network(subnet)
+    results = await asyncio.get_running_loop().run_in_executor(
+        None, probe_hosts, network.hosts(), port, timeout
+    )
+
+    # Report after the scan so probes never wait on console output
+    devices = []
+    for ip, error in sorted(results, key=lambda result: ipaddress.IPv4Address(result[0])):
+        if error is None:
+            print(f"Device found at {ip}")
+            devices.append(ip)
+        else:
+            print(f"Error scanning {ip}: {error}")
+
+    return devices
+
+# Scan the network and check each device for the protocol in one event loop pass
+async def discover_devices(protocol_function, subnet, port, scan_timeout, timeout, retries):
+    """Scan the subnet and return the IPs that pass the protocol check."""
+    devices = await scan_network(subnet, port, scan_timeout)
+
+    if not protocol_function:
+        return []
 
-# Check each device for the Modbus protocol
-if protocol_function:
     for device_ip in devices:
         print(f"\nChecking Modbus device at {device_ip}...")
-        if protocol_function(device_ip, config["modbus_settings"]["port"], 
-                              config["modbus_settings"]["timeout"], 
-                              config["modbus_settings"]["retries"]):
-            config["connected_devices"].append({"ip": device_ip, "protocol": "modbus"})
+    checks = await asyncio.gather(*(protocol_function(device_ip, port, timeout, retries)
+                                    for device_ip in devices))
 
-# Save connected devices to a JSON file
+    return [device_ip for device_ip, ok in zip(devices, checks) if ok]
+
+# Modbus protocol: Only Modbus will be used here
+selected_protocol = "modbus"
+
+# Output file for the list of connected devices
 output_file = 'connected_devices.json'
-if not os.path.exists(output_file):
+
+# Scan the network, save and return the connected devices
+async def scan(config):
+    """Scan the network for Modbus devices and return them as a list of {ip, protocol} dicts."""
+    # Import the Modbus protocol function
+    protocol_function = import_protocol_function(selected_protocol)
+
+    # Scan the network and check each device for the Modbus protocol
+    found = await discover_devices(protocol_function,
+                                   config["network_scan"]["subnet"],
+                                   config["modbus_settings"]["port"],
+                                   config["network_scan"]["scan_timeout"],
+                                   config["modbus_settings"]["timeout"],
+                                   config["modbus_settings"]["retries"])
+
+    connected = list(config["connected_devices"])
+    for device_ip in found:
+        connected.append({"ip": device_ip, "protocol": "modbus"})
+
+    # Save connected devices to a JSON file
     with open(output_file, 'w') as f:
-        json.dump([], f)  # Create the file if it doesn't exist
+        json.dump(connected, f, indent=4)
 
-with open(output_file, 'w') as f:
-    json.dump(config["connected_devices"], f, indent=4)
+    # Output the list of connected devices
+    print("\nConnected devices:")
+    for device in connected:
+        print(f"IP: {device['ip']}, Protocol: {device['protocol']}")
 
-# Output the list of connected devices
-print("\nConnected devices:")
-for device in config["connected_devices"]:
-    print(f"IP: {device['ip']}, Protocol: {device['protocol']}")
+    return connected
 
+if __name__ == "__main__":
+    asyncio.run(scan(load_config()))
@@ -1,14 +1,22 @@
-import socket
+import asyncio
 
-def check_modbus_device(ip, port, timeout, retries):
+async def check_modbus_device(ip, port, timeout, retries):
     """Check if a Modbus device is reachable on the given IP and port."""
     try:
         for _ in range(retries):
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(timeout)
-                result = s.connect_ex((ip, port))
-                if result == 0:
-                    return True
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+            except (asyncio.TimeoutError, OSError):
+                continue
+
+            # The connect succeeded; a reset while closing (e.g. a device at its
+            # connection limit) doesn't make it unreachable
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return True
         return False
     except Exception as e:
         print(f"Error checking Modbus device at {ip}: {e}")